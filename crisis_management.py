@@ -1,39 +1,168 @@
 # api.py
+import asyncio
+import base64
+import hashlib
+import hmac
 import os
+import threading
 import time
 import uuid
 from datetime import date as DtDate
-from typing import Any, Dict, Optional, List
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Annotated, Any, AsyncIterator, Dict, Optional, List, Tuple, Type, TypeVar
 
-from fastapi import FastAPI, BackgroundTasks, Header, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel, Field
-from dotenv import load_dotenv
-from openai import OpenAI
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, ORJSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError, computed_field, model_validator
+from openai import AsyncOpenAI
+import httpx
+from cachetools import TTLCache
 import jwt
+import orjson
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
 import logging
 
-from database import fetch_latest_result, save_result  # <- our fixed helpers
+# database loads .env on import, so the settings below already see it.
+from database import (  # <- our fixed helpers
+    claim_stale_batches, delete_batch, fetch_latest_result, save_batch,
+    save_result, save_results_bulk, touch_batch,
+)
+from semantic_cache import SemanticCache
 
 # -----------------------------------------------------------------------------
 # Setup
 # -----------------------------------------------------------------------------
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+@lru_cache(maxsize=None)
+def settings() -> SimpleNamespace:
+    """Environment-derived configuration, read and parsed once per process."""
+    origins = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "*").split(",") if o.strip()]
+    llm_max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY") or 16)
+    # Background jobs get at most half the LLM slots by default, and never all
+    # of them, so /chat and /start_sync* always find a free one.
+    job_max_concurrency = int(os.getenv("JOB_MAX_CONCURRENCY") or max(1, llm_max_concurrency // 2))
+    if not 1 <= job_max_concurrency <= max(1, llm_max_concurrency - 1):
+        raise ValueError(
+            f"JOB_MAX_CONCURRENCY={job_max_concurrency} must be between 1 and "
+            f"LLM_MAX_CONCURRENCY - 1 ({llm_max_concurrency - 1})"
+        )
+    return SimpleNamespace(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        # Any "*" entry means allow all, however it was written ("*", "*,*", " * ").
+        allowed_origins=["*"] if "*" in origins else origins,
+        jwt_secret=os.getenv("JWT_SECRET") or os.urandom(32),
+        jwt_alg="HS256",
+        llm_max_concurrency=llm_max_concurrency,
+        openai_max_retries=int(os.getenv("OPENAI_MAX_RETRIES") or 2),
+        job_max_concurrency=job_max_concurrency,
+        job_queue_max=int(os.getenv("JOB_QUEUE_MAX") or 1000),
+        openai_batch_enabled=os.getenv("OPENAI_BATCH_ENABLED", "").lower() in ("1", "true", "yes"),
+        batch_max_items=int(os.getenv("BATCH_MAX_ITEMS") or 100),
+        batch_window_seconds=float(os.getenv("BATCH_WINDOW_SECONDS") or 2),
+        batch_poll_seconds=float(os.getenv("BATCH_POLL_SECONDS") or 30),
+        semantic_cache_path=os.getenv("SEMANTIC_CACHE_PATH"),
+        redis_url=os.getenv("REDIS_URL"),
+        semantic_cache_threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD") or 0.92),
+    )
+
+_settings = settings()
+
+# One pooled HTTP/2 client for every OpenAI call: keep-alive connections and
+# multiplexed streams instead of a TLS handshake per burst.
+_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=200),
+    # Fail fast on an unreachable endpoint. 60 s between bytes suits /chat and
+    # the streamed narrative; whole-answer calls use _long_client below.
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+# The SDK retries connection errors, 408/409/429 and 5xx with exponential
+# backoff and jitter (honouring Retry-After), so a job only fails, and writes
+# its error row, once those attempts are used up.
+client = AsyncOpenAI(
+    api_key=_settings.openai_api_key,
+    http_client=_http,
+    max_retries=_settings.openai_max_retries,
+)
+# Same connection pool, but with the SDK's default 600 s read timeout: a
+# non-streamed gpt-4o narrative only sends its first byte once the whole
+# answer is generated, and a premature timeout is retried from scratch.
+# Also used for Batch API file uploads/downloads.
+LONG_CALL_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+_long_client = client.with_options(timeout=LONG_CALL_TIMEOUT)
+
+# Caps in-flight OpenAI calls per process; size it to the account's rate limit.
+LLM_MAX_CONCURRENCY = _settings.llm_max_concurrency
+_llm_sem = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+# /start jobs run on this many worker tasks. Each holds at most one _llm_sem
+# slot, and settings() keeps this below LLM_MAX_CONCURRENCY, so a burst of
+# jobs cannot take every LLM slot. Beyond JOB_QUEUE_MAX waiting jobs, /start
+# waits for room.
+JOB_MAX_CONCURRENCY = _settings.job_max_concurrency
+JOB_QUEUE_MAX = _settings.job_queue_max
+
+# Opt-in: route /start jobs through the OpenAI Batch API (cheaper, but results
+# may take up to the 24h completion window to land).
+OPENAI_BATCH_ENABLED = _settings.openai_batch_enabled
+BATCH_MAX_ITEMS = _settings.batch_max_items
+BATCH_WINDOW_SECONDS = _settings.batch_window_seconds
+BATCH_POLL_SECONDS = _settings.batch_poll_seconds
+
+# Result rows are written by a single background writer in small batches.
+WRITE_BATCH_MAX = 64
+WRITE_BATCH_WAIT_SECONDS = 0.05
+
+# Opt-in: reuse narratives for near-identical crisis inputs (see semantic_cache.py).
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Shortened text-embedding-3 vectors: 6x less work per comparison than the
+# full 1536 dimensions, with little loss for near-duplicate detection.
+EMBEDDING_DIMENSIONS = 256
+_semantic_cache = (
+    SemanticCache(_settings.semantic_cache_path, threshold=_settings.semantic_cache_threshold)
+    if _settings.semantic_cache_path else None
+)
 
-ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*").split(",")
-JWT_SECRET = os.getenv("JWT_SECRET") or os.urandom(32)
-JWT_ALG = "HS256"
+ALLOWED_ORIGINS = _settings.allowed_origins
+JWT_SECRET = _settings.jwt_secret
+JWT_ALG = _settings.jwt_alg
+
+# Decoded claims keyed by SHA-256 of the raw token; entries are still
+# re-checked against their own `exp` before being trusted.
+_jwt_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_jwt_cache_lock = threading.Lock()
+# Tokens we issue always carry these claims; reject anything else up front.
+_JWT_DECODE_OPTIONS = {"require": ["exp", "sid", "uid"], "verify_aud": False, "verify_iss": False}
 
 log = logging.getLogger("crm_api")
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="Crisis Management API", version="1.3.2")
+# orjson renders the (often multi-KB) narrative bodies much faster than json.dumps.
+app = FastAPI(title="Crisis Management API", version="1.3.2", default_response_class=ORJSONResponse)
+
+class _GZipExceptStreams(GZipMiddleware):
+    """
+    Gzip for JSON/text responses, except the token-streaming routes: the
+    compressor would hold tokens back until it had a full block to emit.
+    """
+    STREAMING_PATHS = frozenset({"/chat", "/start_sync_stream"})
 
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.STREAMING_PATHS:
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+# Narratives are long Arabic prose and compress well; tiny bodies are left alone.
+app.add_middleware(_GZipExceptStreams, minimum_size=1024)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=ALLOWED_ORIGINS if ALLOWED_ORIGINS != ["*"] else ["*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -42,8 +171,21 @@ app.add_middleware(
 # -----------------------------------------------------------------------------
 # Models
 # -----------------------------------------------------------------------------
+class RiskScores(BaseModel):
+    reach: int      = Field(..., ge=0, le=20)  # R
+    velocity: int   = Field(..., ge=0, le=15)  # V
+    sentiment: int  = Field(..., ge=0, le=15)  # S
+    safety: int     = Field(..., ge=0, le=20)  # H
+    legal: int      = Field(..., ge=0, le=10)  # L
+    vip_policy: int = Field(..., ge=0, le=10)  # P
+    evidence: int   = Field(..., ge=0, le=10)  # E
+
+# Length caps keep a single oversized request from turning into a huge prompt;
+# pydantic-core rejects it (422) before any of our code runs.
+_ShortText = Annotated[str, Field(max_length=500)]
+
 class CrisisInput(BaseModel):
-    crisis_description: Optional[str] = None
+    crisis_description: Optional[str] = Field(None, max_length=8_000)
     sector: Optional[str] = None
     origin: Optional[str] = None
     audience_locales: Optional[List[str]] = None
@@ -51,7 +193,7 @@ class CrisisInput(BaseModel):
     urgency_level: Optional[str] = None
     language: Optional[str] = None
     preferred_tone: Optional[List[str]] = None
-    constraints: Optional[List[str]] = None
+    constraints: Optional[List[_ShortText]] = Field(None, max_length=50)
     brand_style: Optional[Dict[str, Any]] = None
     kb_tags: Optional[List[str]] = None
     channels_context: Optional[Dict[str, Any]] = None
@@ -61,12 +203,31 @@ class CrisisInput(BaseModel):
     safety_implications: Optional[bool] = None
     vip_involved: Optional[bool] = None
     date: Optional[DtDate] = None
+    risk_scores: Optional[RiskScores] = None
+
+    @computed_field
+    @property
+    def precomputed_risk(self) -> Optional[Dict[str, Any]]:
+        # Deterministic total/level so the model quotes them instead of doing the math.
+        if self.risk_scores is None:
+            return None
+        total = _risk_total(self.risk_scores)
+        return {"total": total, "level": _risk_level(total)}
+
+    @model_validator(mode="before")
+    @classmethod
+    def _canonical_language(cls, values: Any) -> Any:
+        # Non-string values are left for type validation to reject (422).
+        if isinstance(values, dict) and isinstance(values.get("language"), str):
+            values = dict(values)
+            _normalize_language(values)
+        return values
 
 class StartPayload(BaseModel):
     request_id: int = Field(..., gt=0)
     user_id: int    = Field(..., gt=0)
     data: Optional[CrisisInput] = None
-    data_raw: Optional[str] = None
+    data_raw: Optional[str] = Field(None, max_length=16_000)
 
 class ResultRequest(BaseModel):
     request_id: int = Field(..., gt=0)
@@ -109,72 +270,143 @@ class ChatIn(BaseModel):
 # -----------------------------------------------------------------------------
 # Helpers
 # -----------------------------------------------------------------------------
+_LANG_MAP = {
+    "العربية": "ar", "arabic": "ar", "ar": "ar",
+    "الإنجليزية": "en", "english": "en", "en": "en",
+}
+
 def _normalize_language(d: Dict[str, Any]) -> None:
-    lang = (d.get("language") or "").strip().lower()
-    if lang in ("العربية", "arabic", "ar"):
-        d["language"] = "ar"
-    elif lang in ("الإنجليزية", "english", "en"):
-        d["language"] = "en"
+    mapped = _LANG_MAP.get((d.get("language") or "").strip().lower())
+    if mapped:
+        d["language"] = mapped
+
+# Thresholds from the prompt's scale: 0–29 منخفض، 30–59 متوسط، 60–79 مرتفع، 80–100 حرج.
+_RISK_LEVELS = ((80, "حرج"), (60, "مرتفع"), (30, "متوسط"), (0, "منخفض"))
+
+def _risk_total(r: RiskScores) -> int:
+    return r.reach + r.velocity + r.sentiment + r.safety + r.legal + r.vip_policy + r.evidence
+
+def _risk_level(total: int) -> str:
+    return next(label for floor, label in _RISK_LEVELS if total >= floor)
 
-def _to_llm_input(data: Optional[CrisisInput], data_raw: Optional[str]):
+def _to_llm_input(data: Optional[CrisisInput], data_raw: Optional[str]) -> str:
+    """The model's `data:` block as a JSON string (language already normalized)."""
     if data is not None:
-        d = data.model_dump(exclude_none=True)
-        if isinstance(d, dict):
-            _normalize_language(d)
-        return d
+        # Serialized by pydantic-core straight to JSON, no intermediate dict.
+        return data.model_dump_json(exclude_none=True)
     elif data_raw:
-        return data_raw
-    return {}
+        try:
+            orjson.loads(data_raw)
+            return data_raw
+        except orjson.JSONDecodeError:
+            return orjson.dumps({"raw": data_raw}).decode()
+    return "{}"
+
+# (attribute, label prefix) in display order; the plan text goes on its own line.
+_CONTEXT_FIELDS = (
+    ("sector",             "القطاع: "),
+    ("origin",             "المصدر: "),
+    ("language",           "اللغة: "),
+    ("urgency_level",      "الإلحاح: "),
+    ("preferred_tone",     "النبرة: "),
+    ("kb_tags",            "وسوم: "),
+    ("constraints",        "قيود: "),
+    ("audience_locales",   "مناطق الجمهور: "),
+    ("public_sentiment",   "انطباع الجمهور: "),
+    ("date",               "التاريخ: "),
+    ("crisis_description", "وصف الأزمة: "),
+    ("crisis_plan",        "أحدث نص:\n"),
+)
 
 def _values_to_context(values: List[VisibleValue]) -> str:
     if not values:
         return "لا توجد بيانات مرئية حالياً لهذا المستخدم."
     v = values[0]
-    parts = []
-    if v.sector:             parts.append(f"القطاع: {v.sector}")
-    if v.origin:             parts.append(f"المصدر: {v.origin}")
-    if v.language:           parts.append(f"اللغة: {v.language}")
-    if v.urgency_level:      parts.append(f"الإلحاح: {v.urgency_level}")
-    if v.preferred_tone:     parts.append(f"النبرة: {v.preferred_tone}")
-    if v.kb_tags:            parts.append(f"وسوم: {v.kb_tags}")
-    if v.constraints:        parts.append(f"قيود: {v.constraints}")
-    if v.audience_locales:   parts.append(f"مناطق الجمهور: {v.audience_locales}")
-    if v.public_sentiment:   parts.append(f"انطباع الجمهور: {v.public_sentiment}")
-    if v.date:               parts.append(f"التاريخ: {v.date}")
-    if v.crisis_description: parts.append(f"وصف الأزمة: {v.crisis_description}")
-    if v.crisis_plan:        parts.append(f"أحدث نص:\n{v.crisis_plan}")
-    return " | ".join(parts) if parts else "لا توجد تفاصيل كافية."
+    return (
+        " | ".join(label + val for attr, label in _CONTEXT_FIELDS if (val := getattr(v, attr)))
+        or "لا توجد تفاصيل كافية."
+    )
+
+# HS256 tokens are assembled by hand: the header never changes, so only the
+# payload is serialized and signed per session. PyJWT still verifies them.
+_JWT_HEADER_B64 = b"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9"  # {"alg":"HS256","typ":"JWT"}
+_JWT_KEY = JWT_SECRET.encode() if isinstance(JWT_SECRET, str) else JWT_SECRET
+
+def _b64url(raw: bytes) -> bytes:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=")
 
 def _make_jwt(session_id: str, user_id: int) -> str:
+    now = int(time.time())
     payload = {
         "sid": session_id,
         "uid": user_id,
-        "iat": int(time.time()),
-        "exp": int(time.time()) + 60 * 60 * 2,  # 2 hours
+        "iat": now,
+        "exp": now + 60 * 60 * 2,  # 2 hours
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALG)
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(orjson.dumps(payload))
+    signature = _b64url(hmac.new(_JWT_KEY, signing_input, hashlib.sha256).digest())
+    return (signing_input + b"." + signature).decode()
 
 def _verify_jwt(bearer: Optional[str]):
     if not bearer or not bearer.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing Authorization header")
     token = bearer.split(" ", 1)[1]
+    key = hashlib.sha256(token.encode()).digest()
+    with _jwt_cache_lock:
+        claims = _jwt_cache.get(key)
+    if claims is not None and claims.get("exp", 0) > time.time():
+        return claims
     try:
-        jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG], options=_JWT_DECODE_OPTIONS)
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    with _jwt_cache_lock:
+        _jwt_cache[key] = claims
+    return claims
+
+# POST bodies are decoded by pydantic-core straight from bytes
+# (model_validate_json) instead of FastAPI's json.loads + python-mode
+# validation pass; the schema is still published through openapi_extra.
+M = TypeVar("M", bound=BaseModel)
 
-def _nostore(resp: dict) -> JSONResponse:
-    r = JSONResponse(resp)
-    r.headers["Cache-Control"] = "no-store, no-cache, must-revalidate"
-    r.headers["Pragma"] = "no-cache"
-    r.headers["Expires"] = "0"
-    return r
+def _parse_body(model: Type[M], raw: bytes) -> M:
+    try:
+        return model.model_validate_json(raw)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        )
+
+def _json_body(model: Type[BaseModel]) -> Dict[str, Any]:
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            ref = node.get("$ref", "")
+            if ref.startswith("#/$defs/"):
+                return inline(defs[ref.rsplit("/", 1)[1]])
+            return {k: inline(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [inline(v) for v in node]
+        return node
+
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": inline(schema)}}}}
+
+_NOSTORE_HEADERS = {
+    "Cache-Control": "no-store, no-cache, must-revalidate",
+    "Pragma": "no-cache",
+    "Expires": "0",
+}
+
+def _nostore(resp: dict) -> ORJSONResponse:
+    return ORJSONResponse(resp, headers=_NOSTORE_HEADERS)
 
 # -----------------------------------------------------------------------------
 # LLM (narrative)
 # -----------------------------------------------------------------------------
-def crisis_management_narrative(data: Any) -> str:
-    prompt = f"""
+# Static prefix: built once at import, only the user message varies per call.
+_SYSTEM_PROMPT = """
     أنت مستشار أزمات اتصالية احترافي.
     - التزم بالقانون والسياسات الداخلية، وتجنّب الافتراضات غير المؤكدة.
     - إن لم تتوفر معلومة، أوصِ بجمعها بدل تخمينها.
@@ -249,57 +481,182 @@ def crisis_management_narrative(data: Any) -> str:
     - إذا كانت الحساسية القانونية = مرتفعة/حرجة: صياغة شديدة الحذر + مراجعة قانونية إلزامية + تجنّب التفاصيل غير المثبتة.
     - إذا كان النوع = معلومات مضللة مع أدلة قوية: اتجه لتصحيح المعلومات أو نفي مدعوم بالأدلة.
     - إذا وُجدت مؤشرات على مسؤولية داخلية: فضّل «إقرار وتفسير» أو «إقرار والتحقيق»، وقد تُضاف صيغة اعتذار مشروط/كامل وفق الأدلة.
+    - إذا تضمنت المدخلات risk_scores و precomputed_risk: استخدم الدرجات كما هي، واعتمد precomputed_risk.total «معدل الخطر» و precomputed_risk.level «مستوى الخطر» حرفيًا دون إعادة الحساب، واكتفِ بشرح سبب كل درجة.
 
     مهم:
     - كن عمليًا ودقيقًا، وقدّم سببًا واضحًا لكل اختيار.
     - لا تستخدم JSON أو ترميز برمجي؛ الإخراج نصي إنساني قابل للقراءة والتطبيق الفوري.
+
+    You are an expert assistant. Always give long, detailed, and accurate answers with examples.
     """
-    
-    resp = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "system", "content": "You are an expert assistant. Always give long, detailed, and accurate answers with examples."},
-            {"role": "user",   "content": f" data:{data}"},
-        ],
-    )
+
+_NARRATIVE_PREFIX = (
+    {"role": "system", "content": _SYSTEM_PROMPT},
+)
+
+# The system prefix above is byte-identical on every call, so OpenAI's automatic
+# prompt caching can reuse it; a stable key routes those calls to the same cache.
+PROMPT_CACHE_KEY = "crisis_mgmt_narrative_v2"
+
+def _data_block(data: Any) -> str:
+    # Compact JSON (not the dict repr) keeps the prompt short; orjson emits
+    # UTF-8 as is, so Arabic text is not inflated into \uXXXX escapes.
+    if isinstance(data, str):
+        return data
+    return orjson.dumps(data, default=str).decode()
+
+def _narrative_messages(data: Any) -> List[Dict[str, str]]:
+    return [*_NARRATIVE_PREFIX, {"role": "user", "content": f"data: {_data_block(data)}"}]
+
+def _narrative_request(data: Any) -> Dict[str, Any]:
+    """
+    Chat Completions kwargs for one narrative. The buffered, streaming and
+    Batch API paths all build their request here so they cannot drift apart.
+    """
+    return {
+        "model": "gpt-4o",
+        "messages": _narrative_messages(data),
+        "extra_body": {"prompt_cache_key": PROMPT_CACHE_KEY},
+    }
+
+async def crisis_management_narrative(data: Any) -> str:
+    async with _llm_sem:
+        resp = await _long_client.chat.completions.create(**_narrative_request(data))
     return resp.choices[0].message.content
 
+async def crisis_management_narrative_stream(data: Any) -> AsyncIterator[str]:
+    """Same request as crisis_management_narrative, yielding text deltas as they arrive."""
+    async with _llm_sem:
+        response = await client.chat.completions.create(**_narrative_request(data), stream=True)
+        # Closing the stream on exit (incl. client disconnect) returns the connection to the pool.
+        async with response:
+            async for chunk in response:
+                if chunk.choices:
+                    delta = getattr(chunk.choices[0].delta, "content", None)
+                    if delta:
+                        yield delta
+
+# Fields that must match exactly before two inputs may share a cached narrative.
+_CACHE_GUARD_FIELDS = (
+    "language", "sector", "origin", "urgency_level", "coverage",
+    "legal_sensitivity", "safety_implications", "vip_involved",
+    # Tenant-specific rules and signature that end up verbatim in the plan
+    "brand_style", "constraints", "channels_context", "time_horizon_hours",
+    # The prompt quotes the total/level verbatim, so they must match too.
+    "precomputed_risk",
+)
+
+async def cached_narrative(data: Any, user_id: int) -> str:
+    """
+    crisis_management_narrative behind the semantic cache, when enabled.
+    Entries are scoped to `user_id`: a narrative carries its requester's facts
+    and drafted statements, so it is never served to anyone else.
+    """
+    if _semantic_cache is None:
+        return await crisis_management_narrative(data)
+    canonical = _data_block(data)
+    try:
+        fields = orjson.loads(canonical)
+    except orjson.JSONDecodeError:
+        fields = None
+    if isinstance(fields, dict):
+        guard = orjson.dumps([user_id, *(fields.get(f) for f in _CACHE_GUARD_FIELDS)]).decode()
+    else:
+        guard = orjson.dumps([user_id, "raw"]).decode()
+    key = SemanticCache.key_for(f"{user_id}\n{canonical}")
+    hit = _semantic_cache.get_exact(key)
+    if hit is not None:
+        return hit
+    try:
+        emb = (await client.embeddings.create(
+            model=EMBEDDING_MODEL, input=canonical, dimensions=EMBEDDING_DIMENSIONS,
+        )).data[0].embedding
+        hit = await run_in_threadpool(_semantic_cache.lookup, guard, emb)
+    except Exception as e:
+        log.warning("Semantic cache lookup failed, skipping it: %s", e)
+        return await crisis_management_narrative(data)
+    if hit is not None:
+        return hit
+    text = await crisis_management_narrative(data)
+    try:
+        await run_in_threadpool(_semantic_cache.add, key, guard, emb, text)
+    except Exception as e:
+        # e.g. "database is locked" with several processes on one file;
+        # the narrative itself is fine, only caching it failed.
+        log.warning("Semantic cache add failed: %s", e)
+    return text
+
 # -----------------------------------------------------------------------------
 # Routes
 # -----------------------------------------------------------------------------
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True}
 
-@app.post("/start", response_model=ApiStatus)
-def start(payload: StartPayload, bg: BackgroundTasks):
-    existing = fetch_latest_result(payload.request_id)
+@app.post("/start", response_model=ApiStatus, openapi_extra=_json_body(StartPayload))
+async def start(request: Request):
+    payload = _parse_body(StartPayload, await request.body())
+    existing = await run_in_threadpool(fetch_latest_result, payload.request_id)
     if existing:
         return ApiStatus(status="done", result=(existing.get("edited_result") or existing.get("result")))
-    bg.add_task(process_job, payload)
+    if _arq is not None:
+        # Same job id while one is pending/running, so repeat polls don't enqueue twice.
+        await _arq.enqueue_job(
+            "process_job_task", payload.model_dump(mode="json"),
+            _job_id=f"crisis:{payload.request_id}:{payload.user_id}",
+        )
+    else:
+        key = (payload.request_id, payload.user_id)
+        if key not in _jobs_pending:
+            _jobs_pending.add(key)
+            await _job_queue.put(payload)
     return ApiStatus(status="processing")
 
-@app.post("/start_sync", response_model=ApiStatus)
-def start_sync(payload: StartPayload):
-    existing = fetch_latest_result(payload.request_id)
+@app.post("/start_sync", response_model=ApiStatus, openapi_extra=_json_body(StartPayload))
+async def start_sync(request: Request):
+    payload = _parse_body(StartPayload, await request.body())
+    existing = await run_in_threadpool(fetch_latest_result, payload.request_id)
     if existing:
         return ApiStatus(status="done", result=(existing.get("edited_result") or existing.get("result")))
     try:
         data_for_llm = _to_llm_input(payload.data, payload.data_raw)
-        raw = crisis_management_narrative(data_for_llm)
-        save_result(request_id=payload.request_id, user_id=payload.user_id, result_text=raw)
+        raw = await cached_narrative(data_for_llm, payload.user_id)
+        _queue_save(payload.request_id, payload.user_id, raw)
         return ApiStatus(status="done", result=raw)
     except Exception as e:
         err_text = f"ERROR: {type(e).__name__}: {e}"
+        _queue_save(payload.request_id, payload.user_id, err_text)
+        return ApiStatus(status="error", message=err_text)
+
+@app.post("/start_sync_stream", openapi_extra=_json_body(StartPayload))
+async def start_sync_stream(request: Request):
+    """
+    Like /start_sync, but forwards narrative tokens as they are generated;
+    the joined text is saved once the stream ends.
+    """
+    payload = _parse_body(StartPayload, await request.body())
+    existing = await run_in_threadpool(fetch_latest_result, payload.request_id)
+    if existing:
+        return PlainTextResponse(existing.get("edited_result") or existing.get("result") or "")
+
+    async def gen():
+        parts: List[str] = []
         try:
-            save_result(request_id=payload.request_id, user_id=payload.user_id, result_text=err_text)
-        finally:
-            return ApiStatus(status="error", message=err_text)
+            data_for_llm = _to_llm_input(payload.data, payload.data_raw)
+            async for delta in crisis_management_narrative_stream(data_for_llm):
+                parts.append(delta)
+                yield delta
+            text = "".join(parts)
+        except Exception as e:
+            text = f"ERROR: {type(e).__name__}: {e}"
+            yield f"\n[خطأ: {type(e).__name__}] {e}"
+        _queue_save(payload.request_id, payload.user_id, text)
+
+    return StreamingResponse(gen(), media_type="text/plain")
 
 @app.post("/result")
-def get_result(req: ResultRequest):
-    row = fetch_latest_result(req.request_id)
+async def get_result(req: ResultRequest):
+    row = await run_in_threadpool(fetch_latest_result, req.request_id)
     if not row:
         log.info("Result: <None> (request_id=%s)", req.request_id)
         return _nostore({"status": "processing"})
@@ -309,61 +666,328 @@ def get_result(req: ResultRequest):
         return _nostore({"status": "processing"})
     return _nostore({"status": "done", "result": text})
 
+# -----------------------------------------------------------------------------
+# Background queues
+# -----------------------------------------------------------------------------
+_background_tasks: set = set()
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)  # keep a strong ref until it finishes
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _collect(queue: asyncio.Queue, max_items: int, window: float) -> list:
+    """Wait for one item, then keep taking more until `max_items` or `window` seconds."""
+    loop = asyncio.get_running_loop()
+    items = [await queue.get()]
+    deadline = loop.time() + window
+    while len(items) < max_items:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+_write_q: "asyncio.Queue[Tuple[int, int, str]]" = asyncio.Queue()
+
+def _queue_save(request_id: int, user_id: int, result_text: str) -> None:
+    _write_q.put_nowait((request_id, user_id, result_text))
+
+async def _result_writer():
+    while True:
+        rows = await _collect(_write_q, WRITE_BATCH_MAX, WRITE_BATCH_WAIT_SECONDS)
+        try:
+            await run_in_threadpool(save_results_bulk, rows)
+        except Exception:
+            log.exception("Result writer failed to save %d rows, retrying one by one", len(rows))
+            # One bad row (or a transient error) must not cost the whole batch.
+            for request_id, user_id, result_text in rows:
+                try:
+                    await run_in_threadpool(save_result, request_id, user_id, result_text)
+                except Exception:
+                    log.exception(
+                        "Result writer dropped result (request_id=%s)", request_id,
+                        extra={"request_id": request_id, "user_id": user_id},
+                    )
+        finally:
+            for request_id, user_id, _ in rows:
+                # The row is committed (or given up on), so /start may now
+                # see it, or enqueue the job afresh.
+                _jobs_pending.discard((request_id, user_id))
+                _write_q.task_done()
+
 # -----------------------------------------------------------------------------
 # Background worker
 # -----------------------------------------------------------------------------
-def process_job(payload: StartPayload):
+async def process_job(payload: StartPayload):
     try:
         data_for_llm = _to_llm_input(payload.data, payload.data_raw)
-        raw = crisis_management_narrative(data_for_llm)
-        save_result(request_id=payload.request_id, user_id=payload.user_id, result_text=raw)
-        log.info("Saved result (request_id=%s)", payload.request_id)
+        raw = await cached_narrative(data_for_llm, payload.user_id)
+        _queue_save(payload.request_id, payload.user_id, raw)
+        log.info("Queued result (request_id=%s)", payload.request_id)
     except Exception as e:
         err_text = f"ERROR: {type(e).__name__}: {e}"
+        _queue_save(payload.request_id, payload.user_id, err_text)
+        log.exception(
+            "process_job failed (request_id=%s): %s", payload.request_id, e,
+            extra={"request_id": payload.request_id, "user_id": payload.user_id},
+        )
+
+_job_queue: "asyncio.Queue[StartPayload]" = asyncio.Queue(maxsize=JOB_QUEUE_MAX)
+# (request_id, user_id) of jobs queued, running or waiting for their result row
+# to be written, so repeat polls don't enqueue twice. Released by _result_writer;
+# every job path (process_job, _run_openai_batch) ends in _queue_save.
+_jobs_pending: set = set()
+# With REDIS_URL set, /start jobs go to the durable arq queue (worker.py)
+# instead of this process; they then survive restarts and are retried.
+_arq: Optional[ArqRedis] = None
+
+async def _job_worker():
+    """
+    One of JOB_MAX_CONCURRENCY loops draining _job_queue.
+    """
+    while True:
+        payload = await _job_queue.get()
         try:
-            save_result(request_id=payload.request_id, user_id=payload.user_id, result_text=err_text)
-        except Exception:
-            pass
-        log.exception("process_job failed: %s", e)
+            await process_job(payload)
+        finally:
+            _job_queue.task_done()
+
+async def _batch_dispatcher():
+    """
+    Batch mode: coalesces queued /start jobs into one OpenAI Batch API job
+    per window.
+    """
+    while True:
+        jobs = await _collect(_job_queue, BATCH_MAX_ITEMS, BATCH_WINDOW_SECONDS)
+        _spawn(_run_openai_batch(jobs))
+
+# -----------------------------------------------------------------------------
+# Batch API worker
+# -----------------------------------------------------------------------------
+
+_BATCH_TERMINAL = ("completed", "failed", "expired", "cancelled")
+# A poller renews its lease every BATCH_POLL_SECONDS; after this long without
+# a renewal another process may take the batch over.
+BATCH_LEASE_SECONDS = int(max(3 * BATCH_POLL_SECONDS, 120))
+# Consecutive poll/download failures tolerated before the batch is cancelled.
+BATCH_GIVE_UP_SECONDS = 3600
+
+async def _run_openai_batch(payloads: List[StartPayload]):
+    # custom_id -> payload; a later duplicate of the same job wins
+    jobs = {f"{p.request_id}:{p.user_id}": p for p in payloads}
+    try:
+        lines = []
+        for cid, p in jobs.items():
+            # Batch lines are raw request bodies, so extra_body is inlined
+            body = _narrative_request(_to_llm_input(p.data, p.data_raw))
+            body.update(body.pop("extra_body"))
+            lines.append(orjson.dumps(
+                {"custom_id": cid, "method": "POST", "url": "/v1/chat/completions", "body": body}
+            ))
+        batch_file = await _long_client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = await _long_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    except Exception as e:
+        log.exception("Batch submission failed: %s", e)
+        for p in jobs.values():
+            _queue_save(p.request_id, p.user_id, f"ERROR: {type(e).__name__}: {e}")
+        return
+    log.info("Submitted batch %s (%d jobs)", batch.id, len(jobs))
+    try:
+        await run_in_threadpool(save_batch, batch.id, list(jobs))
+    except Exception:
+        # Still polled by this process; only a restart would lose it.
+        log.exception("Could not record batch %s for resume", batch.id)
+    await _await_batch(batch.id, list(jobs))
+
+async def _await_batch(batch_id: str, custom_ids: List[str]):
+    """
+    Polls a submitted batch until it reaches a terminal state, then queues a
+    result row for each of its jobs. Transient API errors are retried; only
+    after BATCH_GIVE_UP_SECONDS of consecutive failures is the batch
+    cancelled and its jobs failed.
+    """
+    results: Dict[str, str] = {}
+    status = "unknown"
+    failing_since: Optional[float] = None
+    while True:
+        try:
+            batch = await _long_client.batches.retrieve(batch_id)
+            status = batch.status
+            if status in _BATCH_TERMINAL:
+                results = await _batch_results(batch)
+                break
+            failing_since = None
+        except Exception as e:
+            now = time.monotonic()
+            failing_since = failing_since or now
+            if now - failing_since < BATCH_GIVE_UP_SECONDS:
+                log.warning("Polling batch %s failed, will retry: %s", batch_id, e)
+            else:
+                log.error("Giving up on batch %s after repeated failures: %s", batch_id, e)
+                if status not in _BATCH_TERMINAL:
+                    try:
+                        await _long_client.batches.cancel(batch_id)
+                    except Exception:
+                        log.exception("Could not cancel batch %s", batch_id)
+                status = f"abandoned: {type(e).__name__}: {e}"
+                break
+        try:
+            await run_in_threadpool(touch_batch, batch_id)
+        except Exception as e:
+            log.warning("Could not renew lease on batch %s: %s", batch_id, e)
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+
+    unresolved = [cid for cid in custom_ids if cid not in results]
+    if unresolved:
+        log.warning("Batch %s finished with status=%s, %d jobs unresolved", batch_id, status, len(unresolved))
+    default_err = f"ERROR: BatchFailed: no output for job (batch status={status})"
+    for cid in custom_ids:
+        request_id, user_id = map(int, cid.split(":"))
+        _queue_save(request_id, user_id, results.get(cid, default_err))
+    try:
+        await run_in_threadpool(delete_batch, batch_id)
+    except Exception:
+        log.exception("Could not forget finished batch %s", batch_id)
+
+async def _batch_results(batch) -> Dict[str, str]:
+    """custom_id -> narrative, or an "ERROR: ..." text for failed items."""
+    results: Dict[str, str] = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await _long_client.files.content(file_id)
+        for line in content.content.splitlines():
+            if not line.strip():
+                continue
+            rec = orjson.loads(line)
+            cid = rec.get("custom_id")
+            resp = rec.get("response") or {}
+            if resp.get("status_code") == 200:
+                results[cid] = resp["body"]["choices"][0]["message"]["content"]
+            else:
+                err = rec.get("error") or (resp.get("body") or {}).get("error") or {}
+                results[cid] = f"ERROR: BatchItemFailed: {err.get('message') or resp.get('status_code')}"
+    return results
+
+async def _resume_batches():
+    """Picks up batches whose poller went away (restart, crash) and finishes them."""
+    while True:
+        try:
+            claimed = await run_in_threadpool(claim_stale_batches, BATCH_LEASE_SECONDS)
+        except Exception as e:
+            log.warning("Could not check for batches to resume: %s", e)
+            claimed = []
+        for batch_id, custom_ids in claimed:
+            log.info("Resuming batch %s (%d jobs)", batch_id, len(custom_ids))
+            _spawn(_await_batch(batch_id, custom_ids))
+        await asyncio.sleep(BATCH_LEASE_SECONDS)
+
+@app.on_event("startup")
+async def _warn_ephemeral_jwt_secret():
+    if not os.getenv("JWT_SECRET"):
+        log.warning(
+            "JWT_SECRET is not set: chat tokens are signed with a random per-process key. "
+            "They stop working after a restart and are rejected by every other worker; "
+            "set JWT_SECRET before running more than one worker."
+        )
+
+@app.on_event("startup")
+async def _start_workers():
+    global _arq
+    _spawn(_result_writer())
+    if _settings.redis_url:
+        _arq = await create_pool(RedisSettings.from_dsn(_settings.redis_url))
+    elif OPENAI_BATCH_ENABLED:
+        _spawn(_batch_dispatcher())
+        _spawn(_resume_batches())
+    else:
+        for _ in range(JOB_MAX_CONCURRENCY):
+            _spawn(_job_worker())
+
+@app.on_event("shutdown")
+async def _flush_results():
+    try:
+        await asyncio.wait_for(_write_q.join(), timeout=10)
+    except asyncio.TimeoutError:
+        log.error("Shutdown with %d unsaved results", _write_q.qsize())
+
+@app.on_event("shutdown")
+async def _close_http():
+    await _http.aclose()
+    if _arq is not None:
+        await _arq.close()
 
 # -----------------------------------------------------------------------------
 # Chat
 # -----------------------------------------------------------------------------
 @app.post("/session", response_model=SessionOut)
-def create_session(body: SessionIn):
+async def create_session(body: SessionIn):
     sid = str(uuid.uuid4())
     token = _make_jwt(sid, body.user_id)
     return SessionOut(session_id=sid, token=token)
 
-@app.post("/chat")
-def chat(body: ChatIn, authorization: Optional[str] = Header(None)):
+# Static part of the /chat system prompt; only the visible-values context varies.
+_CHAT_SYSTEM_PREFIX = (
+    "أنت مساعد إدارة الأزمات الاتصالية موثوق يجيب بالاعتماد على البيانات المرئية الحالية للمستخدم. "
+    "إذا كانت المعلومة غير متوفرة فاذكر ذلك صراحةً واقترح ما يمكن فعله للحصول عليها.\n\n"
+    "البيانات المرئية الحالية:\n"
+)
+
+@app.post("/chat", openapi_extra=_json_body(ChatIn))
+async def chat(request: Request, authorization: Optional[str] = Header(None)):
     _verify_jwt(authorization)
+    body = _parse_body(ChatIn, await request.body())
     context = _values_to_context(body.visible_values)
-    sys_prompt = (
-        "أنت مساعد إدارة الأزمات الاتصالية موثوق يجيب بالاعتماد على البيانات المرئية الحالية للمستخدم. "
-        "إذا كانت المعلومة غير متوفرة فاذكر ذلك صراحةً واقترح ما يمكن فعله للحصول عليها.\n\n"
-        f"البيانات المرئية الحالية:\n{context}"
-    )
+    sys_prompt = _CHAT_SYSTEM_PREFIX + context
     user_msg = body.message or ""
 
-    def stream():
+    async def stream():
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                temperature=0.2,
-                messages=[
-                    {"role": "system", "content": sys_prompt},
-                    {"role": "user",   "content": user_msg},
-                ],
-                stream=True
-            )
-            for chunk in response:
-                if chunk.choices:
-                    delta = getattr(chunk.choices[0].delta, "content", None)
-                    if delta:
-                        yield delta
+            async with _llm_sem:
+                response = await client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    temperature=0.2,
+                    messages=[
+                        {"role": "system", "content": sys_prompt},
+                        {"role": "user",   "content": user_msg},
+                    ],
+                    stream=True
+                )
+                # Closing the stream on exit (incl. client disconnect, which
+                # cancels this generator) hands the connection back to the pool.
+                async with response:
+                    async for chunk in response:
+                        if chunk.choices:
+                            delta = getattr(chunk.choices[0].delta, "content", None)
+                            if delta:
+                                yield delta
         except Exception as e:
             yield f"\n[خطأ: {type(e).__name__}] {e}"
 
     return StreamingResponse(stream(), media_type="text/plain")
 
+
+if __name__ == "__main__":
+    import uvicorn
+
+    workers = int(os.getenv("WEB_CONCURRENCY") or 1)
+    if workers > 1 and not os.getenv("JWT_SECRET"):
+        raise SystemExit("WEB_CONCURRENCY > 1 needs JWT_SECRET: each worker would otherwise sign chat tokens with its own key.")
+    uvicorn.run(
+        "crisis_management:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        # Same variable the uvicorn CLI reads for its --workers default
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+    )
@@ -1,12 +1,19 @@
+import logging
 import os
-from typing import Optional, Dict, Any
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
+from mysql.connector.errors import InterfaceError, PoolError
 from dotenv import load_dotenv
+from cachetools import TTLCache
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 # =========================
 # Environment / Config
 # =========================
@@ -18,26 +25,61 @@ DB_PORT = int(os.getenv("DB_PORT") or 3306)
 
 DATA_TABLE    = "A11i_crisis_management_tool"
 RESULTS_TABLE = "A11i_crisis_management_result"
+BATCHES_TABLE = "A11i_crisis_management_batch"
+
+# Latest row per request_id for polling clients (/result, /start*).
+# Only finished rows (non-empty result/edited_result) are cached, so a poll
+# never sees a stale "not ready"; save_result evicts on write.
+_result_cache: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+_result_cache_lock = threading.Lock()
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or 16)
+
+_DB_CONFIG = dict(
+    host=DB_HOST,
+    database=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    port=DB_PORT,
+    autocommit=True,   # we also commit explicitly when needed
+)
+
+# Created on first use so importing this module never touches the network.
+_pool: Optional[pooling.MySQLConnectionPool] = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> pooling.MySQLConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="crisis_management",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=True,
+                    **_DB_CONFIG,
+                )
+                log.info("MySQL pool ready (%d connections)", DB_POOL_SIZE)
+    return _pool
 
 def get_db_connection():
     """
     Returns a live MySQL connection or None on failure.
+    Connections come from a process-wide pool; close() hands them back.
+    If every pooled connection is in use, a one-off connection is opened
+    instead of failing the call.
     """
     try:
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            port=DB_PORT,
-            autocommit=True,   # we also commit explicitly when needed
-        )
-        if conn.is_connected():
-            print("✅ Connected!")
-            return conn
+        return _get_pool().get_connection()
+    except PoolError:
+        pass
     except Error as e:
-        print("❌ Failed.")
-        print(f"Error connecting to MySQL: {e}")
+        log.error("Error connecting to MySQL: %s", e)
+        return None
+    try:
+        return mysql.connector.connect(**_DB_CONFIG)
+    except Error as e:
+        log.error("Error connecting to MySQL: %s", e)
     return None
 
 def save_result(request_id: int, user_id: int, result_text: str) -> None:
@@ -47,53 +89,47 @@ def save_result(request_id: int, user_id: int, result_text: str) -> None:
     If a row already exists for (request_id, user_id), update both fields (idempotent).
     This guarantees downstream readers always see a non-NULL edited_result immediately.
     """
+    save_results_bulk([(request_id, user_id, result_text)])
+
+def save_results_bulk(rows: List[Tuple[int, int, str]]) -> None:
+    """
+    Same semantics as save_result() for each (request_id, user_id, result_text),
+    but all rows go out as one multi-row upsert with one commit.
+    Relies on the unique key from sql/001_result_unique_request_user.sql.
+    Raises if no connection can be made, so callers can retry instead of
+    losing the rows.
+    """
+    if not rows:
+        return
     conn = get_db_connection()
     if conn is None:
-        print("❌ No DB connection in save_result()")
-        return
+        log.error("No DB connection in save_results_bulk()")
+        raise InterfaceError("No DB connection in save_results_bulk()")
 
     try:
-        cur = conn.cursor(dictionary=True)
-
-        # Check if we already have a row for this request_id + user_id
-        cur.execute(
+        cur = conn.cursor()
+        # Insert with edited_result = result_text (NOT NULL); on an existing
+        # (request_id, user_id) row, update both fields to keep them in sync
+        # on re-generation.
+        cur.executemany(
             f"""
-              SELECT id, result, edited_result
-              FROM `{RESULTS_TABLE}`
-              WHERE request_id = %s AND user_id = %s
-              ORDER BY id DESC
-              LIMIT 1
+              INSERT INTO `{RESULTS_TABLE}` (request_id, user_id, result, edited_result, date, updated_at)
+              VALUES (%s, %s, %s, %s, CURDATE(), CURDATE())
+              ON DUPLICATE KEY UPDATE
+                result = VALUES(result),
+                edited_result = VALUES(edited_result),
+                updated_at = CURDATE()
             """,
-            (request_id, user_id),
+            [(request_id, user_id, result_text, result_text) for request_id, user_id, result_text in rows],
         )
-        existing = cur.fetchone()
-
-        if existing:
-            # Update both fields to keep them in sync on re-generation
-            cur.execute(
-                f"""
-                  UPDATE `{RESULTS_TABLE}`
-                  SET result = %s,
-                      edited_result = %s,
-                      updated_at = CURDATE()
-                  WHERE id = %s
-                """,
-                (result_text, result_text, existing["id"]),
-            )
-        else:
-            # First insert: set edited_result = result_text (NOT NULL)
-            cur.execute(
-                f"""
-                  INSERT INTO `{RESULTS_TABLE}` (request_id, user_id, result, edited_result, date, updated_at)
-                  VALUES (%s, %s, %s, %s, CURDATE(), CURDATE())
-                """,
-                (request_id, user_id, result_text, result_text),
-            )
 
         conn.commit()
-        print("💾 Data saved successfully")
+        with _result_cache_lock:
+            for request_id, _, _ in rows:
+                _result_cache.pop(request_id, None)
+        log.debug("Saved %d result rows", len(rows))
     except Error as e:
-        print(f"❌ save_result() error: {e}")
+        log.error("save_results_bulk() error: %s", e)
         try:
             conn.rollback()
         except Exception:
@@ -112,11 +148,18 @@ def save_result(request_id: int, user_id: int, result_text: str) -> None:
 def fetch_latest_result(request_id: int) -> Optional[Dict[str, Any]]:
     """
     Returns the latest row (dict) for a given request_id, or None if not found.
-    We order by id DESC first (finer granularity than DATE), then by date.
+    Ordered by id alone (it is unique and follows insertion order), so the
+    idx_req_id index from sql/002_result_request_id_index.sql serves the sort.
+    Hits are served from a short TTL cache so tight polling loops skip the DB.
     """
+    with _result_cache_lock:
+        cached = _result_cache.get(request_id)
+    if cached is not None:
+        return cached
+
     conn = get_db_connection()
     if conn is None:
-        print("❌ No DB connection in fetch_latest_result()")
+        log.error("No DB connection in fetch_latest_result()")
         return None
 
     try:
@@ -126,16 +169,19 @@ def fetch_latest_result(request_id: int) -> Optional[Dict[str, Any]]:
               SELECT id, request_id, user_id, result, edited_result, date, updated_at
               FROM `{RESULTS_TABLE}`
               WHERE request_id = %s
-              ORDER BY id DESC, date DESC
+              ORDER BY id DESC
               LIMIT 1
             """,
             (request_id,),
         )
         row = cur.fetchone()
-        print("Fetched result:", type(row))
+        log.debug("Fetched result for request_id=%s: %s", request_id, "row" if row else None)
+        if row is not None and (row.get("edited_result") or row.get("result")):
+            with _result_cache_lock:
+                _result_cache[request_id] = row
         return row  # may be None
     except Error as e:
-        print(f"❌ fetch_latest_result() error: {e}")
+        log.error("fetch_latest_result() error: %s", e)
         return None
     finally:
         try:
@@ -146,3 +192,68 @@ def fetch_latest_result(request_id: int) -> Optional[Dict[str, Any]]:
             conn.close()
         except Exception:
             pass
+
+# =========================
+# OpenAI Batch API bookkeeping
+# =========================
+# Submitted batches are recorded until their results are saved, so a restart
+# can resume polling instead of paying for results nobody collects. The
+# process polling a batch bumps polled_at; a batch whose polled_at is older
+# than the lease is free to be claimed by another process.
+
+@contextmanager
+def _batch_cursor() -> Iterator[Any]:
+    conn = get_db_connection()
+    if conn is None:
+        raise InterfaceError("No DB connection for batch bookkeeping")
+    try:
+        cur = conn.cursor()
+        try:
+            yield cur
+            conn.commit()
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+def save_batch(batch_id: str, custom_ids: List[str]) -> None:
+    """Records a submitted batch and its custom_ids ("request_id:user_id")."""
+    with _batch_cursor() as cur:
+        cur.execute(
+            f"INSERT INTO `{BATCHES_TABLE}` (batch_id, custom_ids, created_at, polled_at) "
+            "VALUES (%s, %s, NOW(), NOW())",
+            (batch_id, ",".join(custom_ids)),
+        )
+
+def touch_batch(batch_id: str) -> None:
+    """Renews this process's lease on a batch it is polling."""
+    with _batch_cursor() as cur:
+        cur.execute(f"UPDATE `{BATCHES_TABLE}` SET polled_at = NOW() WHERE batch_id = %s", (batch_id,))
+
+def claim_stale_batches(lease_seconds: int) -> List[Tuple[str, List[str]]]:
+    """
+    Takes over batches nobody has polled for `lease_seconds`, returning
+    (batch_id, custom_ids) for each one this process won.
+    """
+    claimed: List[Tuple[str, List[str]]] = []
+    with _batch_cursor() as cur:
+        cur.execute(
+            f"SELECT batch_id, custom_ids FROM `{BATCHES_TABLE}` "
+            "WHERE polled_at < NOW() - INTERVAL %s SECOND",
+            (lease_seconds,),
+        )
+        for batch_id, custom_ids in cur.fetchall():
+            # Conditional update: only one process wins a given batch
+            cur.execute(
+                f"UPDATE `{BATCHES_TABLE}` SET polled_at = NOW() "
+                "WHERE batch_id = %s AND polled_at < NOW() - INTERVAL %s SECOND",
+                (batch_id, lease_seconds),
+            )
+            if cur.rowcount == 1:
+                claimed.append((batch_id, custom_ids.split(",")))
+    return claimed
+
+def delete_batch(batch_id: str) -> None:
+    """Forgets a batch once all of its results have been queued for saving."""
+    with _batch_cursor() as cur:
+        cur.execute(f"DELETE FROM `{BATCHES_TABLE}` WHERE batch_id = %s", (batch_id,))
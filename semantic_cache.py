@@ -0,0 +1,116 @@
+import hashlib
+import operator
+import sqlite3
+import threading
+from array import array
+from itertools import islice
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# =========================
+# Semantic result cache
+# =========================
+# Generated narratives keyed by an embedding of the canonical crisis input.
+# A lookup only compares entries that share the same `guard` (fields that must
+# match exactly, e.g. language and severity flags) so two structurally
+# different crises can never be served each other's plan, however close the
+# free-text description is. Only the newest `max_candidates` entries of a guard
+# are scanned, which bounds the pure-Python dot products per lookup. Entries
+# are persisted to SQLite and loaded back into memory on start.
+
+class SemanticCache:
+    def __init__(self, path: str, threshold: float = 0.92, max_entries: int = 5000, max_candidates: int = 256):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+              CREATE TABLE IF NOT EXISTS narratives (
+                id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                key       TEXT UNIQUE NOT NULL,
+                guard     TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                result    TEXT NOT NULL
+              )
+            """
+        )
+        self._conn.commit()
+        # key -> (guard, unit vector, result), oldest first
+        self._entries: Dict[str, Tuple[str, array, str]] = {}
+        # guard -> its keys, oldest first (dict used as an ordered set)
+        self._by_guard: Dict[str, Dict[str, None]] = {}
+        for key, guard, blob, result in self._conn.execute(
+            "SELECT key, guard, embedding, result FROM narratives ORDER BY id"
+        ):
+            vec = array("f")
+            vec.frombytes(blob)
+            self._entries[key] = (guard, vec, result)
+            self._by_guard.setdefault(guard, {})[key] = None
+
+    @staticmethod
+    def key_for(canonical: str) -> str:
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get_exact(self, key: str) -> Optional[str]:
+        """
+        Returns the cached result for an identical canonical input, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[2] if entry else None
+
+    def lookup(self, guard: str, embedding: Sequence[float]) -> Optional[str]:
+        """
+        Returns the result of the most similar entry with the same guard whose
+        cosine similarity is at least `threshold`, or None. Only the newest
+        `max_candidates` entries of that guard are compared.
+        """
+        query = _unit(embedding)
+        with self._lock:
+            keys = islice(reversed(self._by_guard.get(guard, {})), self.max_candidates)
+            candidates = [self._entries[k][1:] for k in keys]
+        best, best_score = None, self.threshold
+        for vec, result in candidates:
+            if len(vec) != len(query):
+                continue  # stored with a different embedding size
+            score = sum(map(operator.mul, query, vec))
+            if score >= best_score:
+                best, best_score = result, score
+        return best
+
+    def add(self, key: str, guard: str, embedding: Sequence[float], result: str) -> None:
+        vec = _unit(embedding)
+        with self._lock:
+            self._conn.execute("DELETE FROM narratives WHERE key = ?", (key,))
+            self._conn.execute(
+                "INSERT INTO narratives (key, guard, embedding, result) VALUES (?, ?, ?, ?)",
+                (key, guard, vec.tobytes(), result),
+            )
+            self._forget(key)
+            self._entries[key] = (guard, vec, result)
+            self._by_guard.setdefault(guard, {})[key] = None
+
+            # Oldest-first eviction once over capacity
+            stale: List[str] = []
+            while len(self._entries) > self.max_entries:
+                old_key = next(iter(self._entries))
+                self._forget(old_key)
+                stale.append(old_key)
+            if stale:
+                self._conn.executemany("DELETE FROM narratives WHERE key = ?", [(k,) for k in stale])
+            self._conn.commit()
+
+    def _forget(self, key: str) -> None:
+        # Caller holds self._lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            bucket = self._by_guard[entry[0]]
+            bucket.pop(key, None)
+            if not bucket:
+                del self._by_guard[entry[0]]
+
+def _unit(values: Sequence[float]) -> array:
+    vec = array("f", values)
+    norm = sum(x * x for x in vec) ** 0.5 or 1.0
+    return array("f", (x / norm for x in vec))
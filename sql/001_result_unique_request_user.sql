@@ -0,0 +1,14 @@
+-- One result row per (request_id, user_id), so save_results_bulk() can upsert
+-- with INSERT ... ON DUPLICATE KEY UPDATE instead of SELECT-then-write.
+-- Apply once before deploying that change.
+
+-- Keep only the newest row of any existing duplicates.
+DELETE older
+FROM `A11i_crisis_management_result` AS older
+JOIN `A11i_crisis_management_result` AS newer
+  ON newer.request_id = older.request_id
+ AND newer.user_id = older.user_id
+ AND newer.id > older.id;
+
+ALTER TABLE `A11i_crisis_management_result`
+  ADD UNIQUE KEY `uk_req_user` (`request_id`, `user_id`);
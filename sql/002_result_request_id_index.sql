@@ -0,0 +1,6 @@
+-- fetch_latest_result() looks up the newest row for a request_id. With this
+-- index that is a single backward index seek instead of a scan + filesort.
+-- (request_id, user_id) lookups are already covered by uk_req_user from 001.
+
+ALTER TABLE `A11i_crisis_management_result`
+  ADD INDEX `idx_req_id` (`request_id`, `id`);
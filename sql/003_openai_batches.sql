@@ -0,0 +1,12 @@
+-- OpenAI Batch API jobs submitted by the API (OPENAI_BATCH_ENABLED). A row
+-- lives from submission until the batch's results are saved, so a restarted
+-- process can resume polling. polled_at is the poller's lease.
+
+CREATE TABLE IF NOT EXISTS `A11i_crisis_management_batch` (
+  `batch_id`   VARCHAR(64) NOT NULL,
+  `custom_ids` MEDIUMTEXT  NOT NULL,  -- comma-separated "request_id:user_id"
+  `created_at` DATETIME    NOT NULL,
+  `polled_at`  DATETIME    NOT NULL,
+  PRIMARY KEY (`batch_id`),
+  KEY `idx_polled_at` (`polled_at`)
+);
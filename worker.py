@@ -0,0 +1,79 @@
+# worker.py
+# Durable /start job runner. Enabled when REDIS_URL is set; run alongside the
+# API with:
+#   arq worker.WorkerSettings
+import asyncio
+from typing import Any, Dict
+
+from arq import Retry
+from arq.connections import RedisSettings
+from starlette.concurrency import run_in_threadpool
+
+from crisis_management import (
+    LLM_MAX_CONCURRENCY, LONG_CALL_TIMEOUT, StartPayload, _http, _to_llm_input,
+    cached_narrative, client, log, settings,
+)
+from database import save_result
+
+MAX_TRIES = 3
+
+# Worst case for one try: the embedding lookup and the narrative call, each
+# using every SDK attempt at its full read timeout, plus backoff in between.
+_SDK_ATTEMPTS = settings().openai_max_retries + 1
+LLM_TIMEOUT = _SDK_ATTEMPTS * (_http.timeout.read + LONG_CALL_TIMEOUT.read + 10)
+
+async def process_job_task(ctx: Dict[str, Any], payload_dict: Dict[str, Any]) -> None:
+    payload = StartPayload.model_validate(payload_dict)
+    last_try = ctx["job_try"] >= MAX_TRIES
+    try:
+        # Our own deadline, below arq's job_timeout, so a hung call still ends
+        # in the retry/ERROR path here instead of arq silently failing the job.
+        raw = await asyncio.wait_for(
+            cached_narrative(_to_llm_input(payload.data, payload.data_raw), payload.user_id),
+            LLM_TIMEOUT,
+        )
+    except asyncio.CancelledError:
+        # Worker shutdown: arq runs the job again, but not past max_tries, so
+        # the final attempt must leave a row behind.
+        if last_try:
+            await _save_error(payload, "Cancelled")
+        raise
+    except Exception as e:
+        if not last_try:
+            log.warning("process_job_task retry %s (request_id=%s): %s", ctx["job_try"], payload.request_id, e)
+            raise Retry(defer=2 ** ctx["job_try"])
+        log.exception(
+            "process_job_task failed (request_id=%s): %s", payload.request_id, e,
+            extra={"request_id": payload.request_id, "user_id": payload.user_id},
+        )
+        raw = f"ERROR: {type(e).__name__}: {e}"
+    try:
+        await run_in_threadpool(save_result, request_id=payload.request_id, user_id=payload.user_id, result_text=raw)
+    except Exception as e:
+        if not last_try:
+            log.warning("process_job_task save retry %s (request_id=%s): %s", ctx["job_try"], payload.request_id, e)
+            raise Retry(defer=2 ** ctx["job_try"])
+        raise
+
+async def _save_error(payload: StartPayload, reason: str) -> None:
+    try:
+        await run_in_threadpool(
+            save_result, request_id=payload.request_id, user_id=payload.user_id, result_text=f"ERROR: {reason}",
+        )
+    except Exception:
+        log.exception("Could not save ERROR row (request_id=%s)", payload.request_id)
+
+async def shutdown(ctx: Dict[str, Any]) -> None:
+    await client.close()
+
+class WorkerSettings:
+    functions = [process_job_task]
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(settings().redis_url or "redis://localhost:6379")
+    # More jobs than LLM slots would only queue on _llm_sem inside the timeout.
+    max_jobs = LLM_MAX_CONCURRENCY
+    job_timeout = LLM_TIMEOUT + 60  # + room to write the result row
+    max_tries = MAX_TRIES
+    # No stored job result: once a job has finished (or failed outright) its
+    # fixed job id is free again, so the next /start can re-enqueue it.
+    keep_result = 0